@@ -0,0 +1,7 @@
+"""
+One-shot schema/table setup for the deploy pipeline: `python -m app.init_db`
+"""
+from .db import init_db
+
+if __name__ == "__main__":
+    init_db()
@@ -1,13 +1,17 @@
+import itertools
 import os
 import time
-from typing import List
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Response, status
-from fastapi.responses import PlainTextResponse
+from typing import List, Optional
+import anyio
+import orjson
+from fastapi import FastAPI, APIRouter, HTTPException, Body, Depends, Query, Request, Response, status
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from sqlalchemy import select
 from sqlalchemy.orm import Session
 
-from .db import get_session, init_db, engine
+from .db import RUN_DDL, SessionLocal, get_session, init_db
 from .models import Product
 from .schemas import ProductIn, ProductOut
 
@@ -20,32 +24,96 @@ if API_PREFIX and not API_PREFIX.startswith("/"):
     API_PREFIX = "/" + API_PREFIX
 API_PREFIX = API_PREFIX.rstrip("/")
 
+# Rows fetched per server-side cursor round-trip when streaming GET /products
+PRODUCTS_YIELD_PER = 500
+
+# Trust the Gateway's input validation: parse write payloads with orjson and
+# model_construct instead of full pydantic validation. Keep off in dev.
+FAST_MODELS = os.getenv("IDVOM_FAST_MODELS", "0") == "1"
+
 app = FastAPI(title=APP_NAME)
 router = APIRouter(prefix=API_PREFIX)
 
 # ---- Startup: ensure schema + tables exist (idempotent) ----
+# Only with IDVOM_RUN_DDL=1; deploys run `python -m app.init_db` once instead
 @app.on_event("startup")
 def on_startup():
-    init_db()
+    if RUN_DDL:
+        init_db()
+
+# ---- X-User check (Gateway sets X-User) ----
+class UserHeaderMiddleware:
+    """
+    Pure ASGI middleware: for protected requests, read X-User once, reject with 401
+    if it is missing, and store it on request.state.user for require_user.
+    """
+
+    def __init__(self, app, is_protected):
+        self.app = app
+        self.is_protected = is_protected
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and self.is_protected(scope["method"], scope["path"]):
+            user = None
+            for name, value in scope["headers"]:
+                if name == b"x-user":
+                    user = value.decode("latin-1")
+                    break
+            if not user:
+                response = JSONResponse({"detail": "missing X-User"}, status_code=status.HTTP_401_UNAUTHORIZED)
+                await response(scope, receive, send)
+                return
+            scope.setdefault("state", {})["user"] = user
+        await self.app(scope, receive, send)
+
+_PRODUCTS_PATH = f"{API_PREFIX}/products"
+
+def _is_protected(method: str, path: str) -> bool:
+    # Product reads are public; writes require a user
+    return method in ("POST", "PUT", "DELETE") and (path == _PRODUCTS_PATH or path.startswith(_PRODUCTS_PATH + "/"))
+
+# Registered before the metrics middleware so that 401s are still counted
+app.add_middleware(UserHeaderMiddleware, is_protected=_is_protected)
 
 # ---- Prometheus metrics ----
 REQS = Counter("http_requests_total", "Total HTTP requests", ["service", "path", "method", "status"])
 LAT  = Histogram("http_request_duration_seconds", "Request latency", ["service", "path", "method"])
 
+# Label children cached by (path, method[, status]) so each request does one dict read
+_reqs_children = {}
+_lat_children = {}
+# Methods are client-supplied; anything else is labelled "other" to keep cardinality bounded
+_HTTP_METHODS = frozenset(("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "CONNECT", "TRACE"))
+
 @app.middleware("http")
 async def metrics_middleware(request: Request, call_next):
     start = time.time()
     response = await call_next(request)
-    REQS.labels(APP_NAME, request.url.path, request.method, response.status_code).inc()
-    LAT.labels(APP_NAME, request.url.path, request.method).observe(time.time() - start)
+    # Label by route template (e.g. /products/{pid}) to keep cardinality bounded;
+    # requests that never reached a route (404, 401 from UserHeaderMiddleware) share one label
+    route = request.scope.get("route")
+    path = route.path if route is not None else "unmatched"
+    method = request.method if request.method in _HTTP_METHODS else "other"
+    key = (path, method, response.status_code)
+    reqs = _reqs_children.get(key)
+    if reqs is None:
+        reqs = _reqs_children[key] = REQS.labels(APP_NAME, path, method, response.status_code)
+    reqs.inc()
+    lat = _lat_children.get(key[:2])
+    if lat is None:
+        lat = _lat_children[key[:2]] = LAT.labels(APP_NAME, path, method)
+    lat.observe(time.time() - start)
     return response
 
 def require_user(request: Request) -> str:
-    user = request.headers.get("X-User")
+    # Already validated by UserHeaderMiddleware; kept as a dependency for OpenAPI docs
+    user = getattr(request.state, "user", None)
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="missing X-User")
     return user
 
+# GET /health is answered by asgi() below; the route remains for OpenAPI and for
+# serving app.main:app directly
 @app.get("/health", response_class=PlainTextResponse)
 def health():
     return "ok"
@@ -54,17 +122,97 @@ def health():
 def metrics():
     return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
+async def _fast_product_in(request: Request) -> ProductIn:
+    """
+    IDVOM_FAST_MODELS body parser: orjson + model_construct, checking only what
+    the DB write relies on.
+    """
+    try:
+        data = orjson.loads(await request.body())
+        name, price_cents, stock = data["name"], data["price_cents"], data.get("stock", 0)
+        ok = (
+            type(name) is str and bool(name)
+            and type(price_cents) is int and price_cents >= 0
+            and type(stock) is int and stock >= 0
+        )
+    except (orjson.JSONDecodeError, KeyError, TypeError):
+        ok = False
+    if not ok:
+        raise HTTPException(status_code=422, detail="invalid product payload")
+    return ProductIn.model_construct(**data)
+
+# Body source for product writes: strict pydantic validation, or the fast path above
+PRODUCT_BODY = Depends(_fast_product_in) if FAST_MODELS else Body()
+
+class _CleanupStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that always runs `cleanup` once streaming ends, including when
+    the client disconnects mid-stream (Starlette skips `background` in that case).
+    """
+
+    def __init__(self, content, cleanup, **kwargs):
+        super().__init__(content, **kwargs)
+        self._cleanup = cleanup
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            with anyio.CancelScope(shield=True):
+                await run_in_threadpool(self._cleanup)
+
+def _stream_products(first, partitions):
+    """
+    Yield products as a JSON array: the already-fetched first partition, then the
+    remaining PRODUCTS_YIELD_PER-row partitions from the server-side cursor.
+    """
+    yield b"["
+    sep = b""
+    for chunk in itertools.chain((first,), partitions):
+        if not chunk:
+            continue
+        # Rows come from the DB; skip validation
+        yield sep + b",".join(
+            orjson.dumps(
+                ProductOut.model_construct(id=r.id, name=r.name, price_cents=r.price_cents, stock=r.stock).model_dump()
+            )
+            for r in chunk
+        )
+        sep = b","
+    yield b"]"
+
 @router.get("/products", response_model=List[ProductOut])
-def list_products(session: Session = Depends(get_session)):
-    rows = session.execute(select(Product)).scalars().all()
-    return rows
+def list_products(limit: Optional[int] = Query(None, ge=1), offset: int = Query(0, ge=0)):
+    stmt = select(Product.id, Product.name, Product.price_cents, Product.stock).order_by(Product.id)
+    if offset:
+        stmt = stmt.offset(offset)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+
+    # Own session so it outlives the handler. Connect, run the query and fetch the
+    # first partition before any header is sent, so DB errors still surface as a 500.
+    session = SessionLocal()
+    try:
+        result = session.execute(stmt.execution_options(yield_per=PRODUCTS_YIELD_PER))
+        partitions = result.partitions()
+        first = next(partitions, [])
+    except Exception:
+        session.close()
+        raise
+
+    def cleanup():
+        result.close()
+        session.close()
+
+    return _CleanupStreamingResponse(
+        _stream_products(first, partitions), cleanup=cleanup, media_type="application/json"
+    )
 
 @router.post("/products", response_model=ProductOut)
-def create_product(payload: ProductIn, user: str = Depends(require_user), session: Session = Depends(get_session)):
+def create_product(payload: ProductIn = PRODUCT_BODY, user: str = Depends(require_user), session: Session = Depends(get_session)):
     p = Product(name=payload.name, price_cents=payload.price_cents, stock=payload.stock)
     session.add(p)
-    session.flush()
-    session.refresh(p)
+    session.flush()  # assigns p.id; other fields are already in memory
     return p
 
 @router.get("/products/{pid}", response_model=ProductOut)
@@ -75,7 +223,7 @@ def get_product(pid: int, session: Session = Depends(get_session)):
     return p
 
 @router.put("/products/{pid}", response_model=ProductOut)
-def update_product(pid: int, payload: ProductIn, user: str = Depends(require_user), session: Session = Depends(get_session)):
+def update_product(pid: int, payload: ProductIn = PRODUCT_BODY, user: str = Depends(require_user), session: Session = Depends(get_session)):
     p = session.get(Product, pid)
     if not p:
         raise HTTPException(status_code=404, detail="not found")
@@ -84,7 +232,6 @@ def update_product(pid: int, payload: ProductIn, user: str = Depends(require_use
     p.stock = payload.stock
     session.add(p)
     session.flush()
-    session.refresh(p)
     return p
 
 @router.delete("/products/{pid}", status_code=204)
@@ -96,3 +243,22 @@ def delete_product(pid: int, user: str = Depends(require_user), session: Session
     return Response(status_code=204)
 
 app.include_router(router)
+
+# ---- /health short-circuit ----
+_HEALTH_START = {
+    "type": "http.response.start",
+    "status": 200,
+    "headers": [(b"content-type", b"text/plain; charset=utf-8"), (b"content-length", b"2")],
+}
+_HEALTH_BODY = {"type": "http.response.body", "body": b"ok"}
+
+async def asgi(scope, receive, send):
+    """
+    Outermost ASGI entrypoint (app.main:asgi): answers liveness probes on GET /health
+    before middleware and routing, and hands everything else to the FastAPI app.
+    """
+    if scope["type"] == "http" and scope["path"] == "/health" and scope["method"] == "GET":
+        await send(_HEALTH_START)
+        await send(_HEALTH_BODY)
+        return
+    await app(scope, receive, send)
@@ -9,26 +9,55 @@ DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_PORT = os.getenv("DB_PORT", "5432")
 DB_SCHEMA = os.getenv("DB_SCHEMA", "orders")
 CATALOG_SCHEMA = os.getenv("CATALOG_SCHEMA", "catalog")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+# Run init_db() on every process start; otherwise the deploy runs `python -m app.init_db` once
+RUN_DDL = os.getenv("IDVOM_RUN_DDL", "0") == "1"
 
 # search_path: orders first, then catalog, then public
 options = f"-csearch_path={DB_SCHEMA},{CATALOG_SCHEMA},public"
-DATABASE_URL = (
-    f"postgresql+psycopg://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
-    f"?options={options}"
-)
+DATABASE_URL = f"postgresql+psycopg://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True, future=True)
+# prepare_threshold=0: psycopg PREPAREs every statement on first use and reuses
+# the server-side plan for the lifetime of the pooled connection
+engine = create_engine(
+    DATABASE_URL,
+    connect_args={"options": options, "prepare_threshold": 0},
+    pool_pre_ping=True,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=10,
+    pool_recycle=1800,
+    future=True,
+)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
 
+def init_db():
+    """
+    Ensure the schema exists, then create tables (idempotent).
+    Run once per deploy via `python -m app.init_db`, or at startup when IDVOM_RUN_DDL=1.
+    """
+    with engine.begin() as conn:
+        # Quote the schema to avoid edge cases with names
+        conn.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{DB_SCHEMA}"'))
+    # Import here to avoid circulars
+    from .models import Base  # noqa
+    Base.metadata.create_all(bind=engine)
+    # create_all skips existing tables: add indexes introduced after the tables were
+    # created and drop the single-column user_id index superseded by (user_id, id)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
+        conn.execute(text(f'DROP INDEX IF EXISTS "{DB_SCHEMA}".ix_orders_user_id'))
+
 def get_session() -> Session:
     """
     FastAPI dependency that yields a SQLAlchemy Session.
-    Ensures the service schema exists (idempotent), commits on success,
-    rolls back on error, and always closes the session.
+    Commits on success, rolls back on error, and always closes the session.
     """
     s: Session = SessionLocal()
     try:
-        s.execute(text(f"CREATE SCHEMA IF NOT EXISTS {DB_SCHEMA}"))
         yield s
         s.commit()
     except Exception:
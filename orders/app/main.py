@@ -1,25 +1,67 @@
 import os
 import time
-from typing import List, Dict
-from fastapi import FastAPI, HTTPException, Depends, Request, Response, status
-from fastapi.responses import PlainTextResponse
+import orjson
+from typing import List, Dict, Tuple
+from fastapi import FastAPI, HTTPException, Body, Depends, Request, Response, status
+from fastapi.responses import JSONResponse, PlainTextResponse
 from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
-from sqlalchemy import select, text
+from sqlalchemy import ARRAY, BigInteger, bindparam, insert, select, text
 from sqlalchemy.orm import Session
 
-from .db import get_session, engine, CATALOG_SCHEMA
-from .models import Base, Order, OrderItem
-from .schemas import OrderCreate, OrderOut, OrderItemOut
+from .db import get_session, init_db, CATALOG_SCHEMA, DB_SCHEMA, RUN_DDL
+from .models import Order, OrderItem
+from .schemas import OrderCreate, OrderItemIn, OrderOut, OrderItemOut
 
 APP_NAME = "orders"
 LISTEN_PORT = int(os.getenv("LISTEN_PORT", "8000"))
 
+# Rows read from the DB are already typed; when set, list endpoints skip
+# FastAPI's response_model re-validation of the model_construct output.
+TRUST_DB_OUTPUT = os.getenv("IDVOM_TRUST_DB_OUTPUT", "0") == "1"
+
+# Trust the Gateway's input validation: parse order payloads with orjson and
+# model_construct instead of full pydantic validation. Keep off in dev.
+FAST_MODELS = os.getenv("IDVOM_FAST_MODELS", "0") == "1"
+
 app = FastAPI(title=APP_NAME)
 
-# Create tables at startup (idempotent)
+# Ensure schema + tables exist at startup (idempotent).
+# Only with IDVOM_RUN_DDL=1; deploys run `python -m app.init_db` once instead
 @app.on_event("startup")
 def on_startup():
-    Base.metadata.create_all(bind=engine)
+    if RUN_DDL:
+        init_db()
+
+# X-User check (Gateway sets X-User)
+class UserHeaderMiddleware:
+    """
+    Pure ASGI middleware: for protected requests, read X-User once, reject with 401
+    if it is missing, and store it on request.state.user for require_user.
+    """
+
+    def __init__(self, app, is_protected):
+        self.app = app
+        self.is_protected = is_protected
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and self.is_protected(scope["method"], scope["path"]):
+            user = None
+            for name, value in scope["headers"]:
+                if name == b"x-user":
+                    user = value.decode("latin-1")
+                    break
+            if not user:
+                response = JSONResponse({"detail": "missing X-User"}, status_code=status.HTTP_401_UNAUTHORIZED)
+                await response(scope, receive, send)
+                return
+            scope.setdefault("state", {})["user"] = user
+        await self.app(scope, receive, send)
+
+def _is_protected(method: str, path: str) -> bool:
+    return path == "/orders" or path.startswith("/orders/")
+
+# Registered before the metrics middleware so that 401s are still counted
+app.add_middleware(UserHeaderMiddleware, is_protected=_is_protected)
 
 # Prometheus metrics
 REQS = Counter("http_requests_total", "Total HTTP requests", ["service", "path", "method", "status"])
@@ -27,21 +69,42 @@ LAT = Histogram("http_request_duration_seconds", "Request latency", ["service",
 ORDERS_CREATED = Counter("orders_created_total", "Orders created successfully")
 ORDERS_FAILED = Counter("order_create_failures_total", "Order create failures", ["reason"])
 
+# Label children cached by (path, method[, status]) so each request does one dict read
+_reqs_children = {}
+_lat_children = {}
+# Methods are client-supplied; anything else is labelled "other" to keep cardinality bounded
+_HTTP_METHODS = frozenset(("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "CONNECT", "TRACE"))
+
 @app.middleware("http")
 async def metrics_middleware(request: Request, call_next):
     start = time.time()
     response = await call_next(request)
-    REQS.labels(APP_NAME, request.url.path, request.method, response.status_code).inc()
-    LAT.labels(APP_NAME, request.url.path, request.method).observe(time.time() - start)
+    # Label by route template rather than raw URL to keep cardinality bounded;
+    # requests that never reached a route (404, 401 from UserHeaderMiddleware) share one label
+    route = request.scope.get("route")
+    path = route.path if route is not None else "unmatched"
+    method = request.method if request.method in _HTTP_METHODS else "other"
+    key = (path, method, response.status_code)
+    reqs = _reqs_children.get(key)
+    if reqs is None:
+        reqs = _reqs_children[key] = REQS.labels(APP_NAME, path, method, response.status_code)
+    reqs.inc()
+    lat = _lat_children.get(key[:2])
+    if lat is None:
+        lat = _lat_children[key[:2]] = LAT.labels(APP_NAME, path, method)
+    lat.observe(time.time() - start)
     return response
 
-# Gateway sets X-User; require it for protected endpoints
+# Gateway sets X-User; already validated by UserHeaderMiddleware for protected
+# endpoints, kept as a dependency for OpenAPI docs
 def require_user(request: Request) -> str:
-    user = request.headers.get("X-User")
+    user = getattr(request.state, "user", None)
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="missing X-User")
     return user
 
+# GET /health is answered by asgi() below; the route remains for OpenAPI and for
+# serving app.main:app directly
 @app.get("/health", response_class=PlainTextResponse)
 def health():
     return "ok"
@@ -51,40 +114,100 @@ def metrics():
     return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 # ---------- Helpers ----------
-def fetch_prices(session: Session, product_ids: List[int]) -> Dict[int, int]:
+# Built once at import so SQLAlchemy's compiled cache and psycopg's prepared
+# statements are reused across requests. Items are bound as typed bigint[]
+# parameters, so the SQL text is the same whatever the number of items.
+# The `locked` CTE takes the row locks in ascending id order before updating, so
+# concurrent orders over the same products queue up instead of deadlocking
+# (the UPDATE's own join order depends on the plan and cannot guarantee that).
+_RESERVE_AND_PRICE_SQL = text(
+    f"""
+    WITH locked AS MATERIALIZED (
+        SELECT id FROM {CATALOG_SCHEMA}.products
+        WHERE id = ANY(CAST(:pids AS bigint[]))
+        ORDER BY id
+        FOR UPDATE
+    )
+    UPDATE {CATALOG_SCHEMA}.products p
+    SET stock = p.stock - v.qty
+    FROM locked l
+    JOIN unnest(CAST(:pids AS bigint[]), CAST(:qtys AS bigint[])) AS v(pid, qty) ON v.pid = l.id
+    WHERE p.id = l.id AND p.stock >= v.qty
+    RETURNING p.id, p.price_cents
+    """
+).bindparams(
+    bindparam("pids", type_=ARRAY(BigInteger)),
+    bindparam("qtys", type_=ARRAY(BigInteger)),
+)
+_EXISTING_PRODUCTS_SQL = text(
+    f"SELECT id FROM {CATALOG_SCHEMA}.products WHERE id IN (SELECT unnest(CAST(:ids AS bigint[])))"
+).bindparams(bindparam("ids", type_=ARRAY(BigInteger)))
+
+# Upper bound of the int4 products.id / products.stock columns
+INT4_MAX = 2**31 - 1
+
+# Carts with more line items than this are written with COPY instead of INSERT
+ORDER_ITEMS_COPY_THRESHOLD = 50
+_COPY_ORDER_ITEMS_SQL = (
+    f'COPY "{DB_SCHEMA}".order_items (order_id, product_id, qty, price_cents) FROM STDIN (FORMAT BINARY)'
+)
+
+def reserve_and_price(session: Session, items: List[Tuple[int, int]]) -> Dict[int, int]:
     """
-    Read current prices from catalog.products.
-    Returns {product_id: price_cents}. Missing products are omitted.
+    Decrement stock in catalog.products and read prices in a single UPDATE ... RETURNING.
+    `items` is [(product_id, qty)]; product rows are locked in ascending id order
+    (see _RESERVE_AND_PRICE_SQL) so concurrent orders don't deadlock each other.
+    Returns {product_id: price_cents}.
+    Fails with 400 if any product is unknown or doesn't have enough stock.
     """
-    if not product_ids:
+    if not items:
         return {}
-    sql = text(
-        f"SELECT id, price_cents FROM {CATALOG_SCHEMA}.products WHERE id = ANY(:ids)"
-    )
-    rows = session.execute(sql, {"ids": product_ids}).all()
-    return {row[0]: row[1] for row in rows}
+    # Product ids and stock are int4: ids/quantities beyond that can never match or be
+    # satisfied, and would overflow the array cast, so they skip the UPDATE entirely
+    oversized = [pid for pid, qty in items if pid > INT4_MAX or qty > INT4_MAX]
+    if not oversized:
+        params = {"pids": [pid for pid, _ in items], "qtys": [qty for _, qty in items]}
+        prices = {row[0]: row[1] for row in session.execute(_RESERVE_AND_PRICE_SQL, params)}
+        if len(prices) == len(items):
+            return prices
+        missing = short = [pid for pid, _ in items if pid not in prices]
+    else:
+        missing, short = [pid for pid, _ in items], oversized
 
-def reserve_stock(session: Session, items: List[Dict[str, int]]) -> None:
+    # Error path only: tell unknown products apart from insufficient stock
+    ids = [pid for pid in missing if pid <= INT4_MAX]
+    existing = {row[0] for row in session.execute(_EXISTING_PRODUCTS_SQL, {"ids": ids})}
+    unknown = [pid for pid in missing if pid not in existing]
+    if unknown:
+        ORDERS_FAILED.labels(reason="missing_product").inc()
+        raise HTTPException(status_code=400, detail=f"unknown product(s): {unknown}")
+    ORDERS_FAILED.labels(reason="insufficient_stock").inc()
+    raise HTTPException(status_code=400, detail=f"insufficient stock for product(s): {short}")
+
+async def _fast_order_create(request: Request) -> OrderCreate:
     """
-    Decrement stock in catalog.products atomically per item.
-    Fails if any item doesn't have enough stock.
+    IDVOM_FAST_MODELS body parser: orjson + model_construct, checking only what
+    stock reservation relies on (non-empty items, positive integer ids/quantities).
     """
-    for it in items:
-        pid, qty = it["product_id"], it["qty"]
-        upd = text(
-            f"""
-            UPDATE {CATALOG_SCHEMA}.products
-            SET stock = stock - :qty
-            WHERE id = :pid AND stock >= :qty
-            """
+    try:
+        data = orjson.loads(await request.body())
+        items = [OrderItemIn.model_construct(product_id=it["product_id"], qty=it["qty"]) for it in data["items"]]
+        ok = bool(items) and all(
+            type(it.product_id) is int and type(it.qty) is int and it.product_id >= 1 and it.qty >= 1
+            for it in items
         )
-        res = session.execute(upd, {"qty": qty, "pid": pid})
-        if res.rowcount != 1:
-            raise HTTPException(status_code=400, detail=f"insufficient stock for product {pid}")
+    except (orjson.JSONDecodeError, KeyError, TypeError):
+        ok = False
+    if not ok:
+        raise HTTPException(status_code=422, detail="invalid order payload")
+    return OrderCreate.model_construct(items=items)
+
+# Body source for POST /orders: strict pydantic validation, or the fast path above
+ORDER_BODY = Depends(_fast_order_create) if FAST_MODELS else Body()
 
 # ---------- Endpoints ----------
 @app.post("/orders", response_model=OrderOut)
-def create_order(payload: OrderCreate, user: str = Depends(require_user), session: Session = Depends(get_session)):
+def create_order(payload: OrderCreate = ORDER_BODY, user: str = Depends(require_user), session: Session = Depends(get_session)):
     # Validate and normalize items (combine duplicates)
     if not payload.items:
         raise HTTPException(status_code=400, detail="items must not be empty")
@@ -93,62 +216,90 @@ def create_order(payload: OrderCreate, user: str = Depends(require_user), sessio
     for it in payload.items:
         combined[it.product_id] = combined.get(it.product_id, 0) + it.qty
 
-    product_ids = list(combined.keys())
-    prices = fetch_prices(session, product_ids)
-    if len(prices) != len(product_ids):
-        missing = sorted(set(product_ids) - set(prices.keys()))
-        ORDERS_FAILED.labels(reason="missing_product").inc()
-        raise HTTPException(status_code=400, detail=f"unknown product(s): {missing}")
-
-    # Reserve stock first (will raise 400 on insufficient stock)
-    try:
-        reserve_stock(session, [{"product_id": pid, "qty": qty} for pid, qty in combined.items()])
-    except HTTPException as e:
-        ORDERS_FAILED.labels(reason="insufficient_stock").inc()
-        raise e
+    # Reserve stock and snapshot prices (will raise 400 on unknown product / insufficient stock).
+    # Sorted by product_id so items are written and returned in a stable order.
+    ordered_items = sorted(combined.items())
+    prices = reserve_and_price(session, ordered_items)
 
     # Build order & items, snapshot price_cents
-    order = Order(user_id=user, total_cents=0)
-    session.add(order)
-    session.flush()  # get order.id
-
-    total = 0
-    for pid, qty in combined.items():
-        price = prices[pid]
-        total += price * qty
-        oi = OrderItem(order_id=order.id, product_id=pid, qty=qty, price_cents=price)
-        session.add(oi)
-
-    order.total_cents = total
-    session.add(order)
-    session.flush()
-    session.refresh(order)
+    rows = [
+        {"product_id": pid, "qty": qty, "price_cents": prices[pid]}
+        for pid, qty in ordered_items
+    ]
+    total = sum(r["price_cents"] * r["qty"] for r in rows)
+
+    # Total is known up front, so the order row is written once and its id comes back via RETURNING
+    order_id = session.execute(
+        insert(Order).values(user_id=user, total_cents=total).returning(Order.id)
+    ).scalar_one()
+
+    if len(rows) > ORDER_ITEMS_COPY_THRESHOLD:
+        # Large carts: binary COPY on the session's connection (same transaction)
+        with session.connection().connection.cursor() as cur:
+            with cur.copy(_COPY_ORDER_ITEMS_SQL) as cp:
+                cp.set_types(["int4", "int4", "int4", "int4"])
+                for r in rows:
+                    cp.write_row((order_id, r["product_id"], r["qty"], r["price_cents"]))
+    else:
+        # One multi-row INSERT instead of a unit-of-work insert per item
+        session.execute(insert(OrderItem), [{"order_id": order_id, **r} for r in rows])
 
     ORDERS_CREATED.inc()
     return OrderOut(
-        id=order.id,
-        user_id=order.user_id,
-        total_cents=order.total_cents,
-        items=[OrderItemOut(product_id=i.product_id, qty=i.qty, price_cents=i.price_cents) for i in order.items],
+        id=order_id,
+        user_id=user,
+        total_cents=total,
+        items=[OrderItemOut(**r) for r in rows],
     )
 
 @app.get("/orders/me", response_model=List[OrderOut])
 def list_my_orders(user: str = Depends(require_user), session: Session = Depends(get_session)):
-    # Load orders & their items for the current user
-    orders = session.execute(
-        select(Order).where(Order.user_id == user).order_by(Order.id.desc())
-    ).scalars().all()
-
-    out: List[OrderOut] = []
-    for o in orders:
-        # ensure items are present
-        _ = o.items  # materialize relationship
-        out.append(
-            OrderOut(
-                id=o.id,
-                user_id=o.user_id,
-                total_cents=o.total_cents,
-                items=[OrderItemOut(product_id=i.product_id, qty=i.qty, price_cents=i.price_cents) for i in o.items],
-            )
+    # Load orders & their items for the current user in one joined read,
+    # without hydrating ORM entities
+    rows = session.execute(
+        select(
+            Order.id,
+            Order.user_id,
+            Order.total_cents,
+            OrderItem.product_id,
+            OrderItem.qty,
+            OrderItem.price_cents,
         )
-    return out
+        .join(OrderItem, isouter=True)
+        .where(Order.user_id == user)
+        .order_by(Order.id.desc(), OrderItem.id)
+    ).all()
+
+    # Group item rows by order; rows come from the DB so skip re-validation
+    grouped: Dict[int, OrderOut] = {}
+    for oid, user_id, total_cents, product_id, qty, price_cents in rows:
+        o = grouped.get(oid)
+        if o is None:
+            o = grouped[oid] = OrderOut.model_construct(
+                id=oid, user_id=user_id, total_cents=total_cents, items=[]
+            )
+        if product_id is not None:
+            o.items.append(OrderItemOut.model_construct(product_id=product_id, qty=qty, price_cents=price_cents))
+    if TRUST_DB_OUTPUT:
+        # Returning a Response bypasses response_model validation
+        return Response(orjson.dumps([o.model_dump() for o in grouped.values()]), media_type="application/json")
+    return list(grouped.values())
+
+# /health short-circuit
+_HEALTH_START = {
+    "type": "http.response.start",
+    "status": 200,
+    "headers": [(b"content-type", b"text/plain; charset=utf-8"), (b"content-length", b"2")],
+}
+_HEALTH_BODY = {"type": "http.response.body", "body": b"ok"}
+
+async def asgi(scope, receive, send):
+    """
+    Outermost ASGI entrypoint (app.main:asgi): answers liveness probes on GET /health
+    before middleware and routing, and hands everything else to the FastAPI app.
+    """
+    if scope["type"] == "http" and scope["path"] == "/health" and scope["method"] == "GET":
+        await send(_HEALTH_START)
+        await send(_HEALTH_BODY)
+        return
+    await app(scope, receive, send)
@@ -1,14 +1,16 @@
 from datetime import datetime
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from sqlalchemy import ForeignKey, Integer, String, DateTime
+from sqlalchemy import ForeignKey, Index, Integer, String, DateTime
 
 class Base(DeclarativeBase):
     pass
 
 class Order(Base):
     __tablename__ = "orders"
+    # (user_id, id) serves "WHERE user_id = ? ORDER BY id DESC" with one index scan
+    __table_args__ = (Index("ix_orders_user_created", "user_id", "id"),)
     id: Mapped[int] = mapped_column(primary_key=True)
-    user_id: Mapped[str] = mapped_column(String(100), index=True)
+    user_id: Mapped[str] = mapped_column(String(100))
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
     total_cents: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
 
@@ -18,6 +20,7 @@ class Order(Base):
 
 class OrderItem(Base):
     __tablename__ = "order_items"
+    __table_args__ = (Index("ix_order_items_order_id", "order_id"),)
     id: Mapped[int] = mapped_column(primary_key=True)
     order_id: Mapped[int] = mapped_column(ForeignKey("orders.id", ondelete="CASCADE"))
     product_id: Mapped[int] = mapped_column(Integer, nullable=False, index=True)